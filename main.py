@@ -1,19 +1,23 @@
 ### main.py
 
 import csv
+import errno
 import json
 import logging
-import multiprocessing
 import os
 import re
 import shutil
 import subprocess
+import tempfile
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from functools import cached_property
 from logging import DEBUG, ERROR, INFO, WARNING, Formatter, StreamHandler, getLogger
+from operator import attrgetter
 from pathlib import Path
 
-from moviepy.editor import VideoFileClip
-
 # Setup logging
 log = getLogger('movie-merge')
 log_levels = {'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING, 'ERROR': ERROR}
@@ -27,19 +31,35 @@ stream_handler.setFormatter(formatter)
 log.addHandler(stream_handler)
 
 from tools import (
-    burn_title_into_clip,
+    FFMPEG_STALL_TIMEOUT,
+    FFMPEG_STARTUP_STALL_FACTOR,
+    TARGET_RESOLUTION,
+    Encoder,
+    ProbeCache,
+    can_stream_copy,
+    check_ffmpeg_build,
     concatenate_clips,
     create_title_card,
+    encode_clips,
+    encode_clips_in_parallel,
     extract_datetime,
+    fit_resolution,
     get_directory_info,
     get_video_files_in_directory,
+    physical_cpu_count,
+    probe_with_pyav,
+    probe_segment,
+    run_ffmpeg,
+    run_process,
     sort_clips_by_date,
-    write_output_file,
 )
 
+# Files already renamed to their creation date, e.g. 2017-01-01_12-30.mp4
+renamed_file_pattern = re.compile(r"^\d{4}-\d{2}-\d{2}_\d{2}-\d{2}")
+
 
 def validate_thread_count(user_thread_count):
-    max_threads = multiprocessing.cpu_count()
+    max_threads = os.cpu_count() or 1
     if user_thread_count >= max_threads:
         raise ValueError(f"Invalid thread count. The maximum available threads on this system is {max_threads}.")
 
@@ -89,6 +109,70 @@ def getArguments():
                         type=str,
                         default='1',
                         help='Number of threads to use for ffmpeg. Can speed up the writing of the video on multicore computers.')
+    parser.add_argument('-j',
+                        '--jobs',
+                        dest='jobs',
+                        type=int,
+                        default=0,
+                        help='Number of movies to process in parallel. '
+                             'Defaults to the number of physical cores divided by the number of threads.')
+
+    parser.add_argument('--encoder',
+                        dest='encoder',
+                        type=str,
+                        default='auto',
+                        choices=['auto', 'libx264', *Encoder.HARDWARE_ENCODERS],
+                        help='H.264 encoder used when clips have to be re-encoded. '
+                             'auto picks the first working hardware encoder and falls back to libx264 (Default: auto)')
+
+    parser.add_argument('--hwaccel',
+                        dest='hwaccel',
+                        type=str,
+                        default='auto',
+                        choices=['auto', 'none', *Encoder.HWACCELS.values()],
+                        help='Hardware decoder used for clips that are re-encoded. '
+                             'auto uses the hardware of the selected encoder, none decodes on the CPU (Default: auto)')
+
+    parser.add_argument('--preset',
+                        dest='preset',
+                        type=str,
+                        default='veryfast',
+                        help='x264 preset used when clips have to be re-encoded (Default: veryfast). '
+                             'Slower presets than veryfast/faster give little visible gain for a lot more encode time.')
+
+    parser.add_argument('--crf',
+                        dest='crf',
+                        type=int,
+                        default=20,
+                        help='x264 constant rate factor used when clips have to be re-encoded (Default: 20)')
+
+    parser.add_argument('--two-pass',
+                        dest='two_pass',
+                        action='store_true',
+                        help='Encode re-encoded movies in two passes at the --bitrate target instead of CRF. '
+                             'Gives more predictable file sizes, only supported with libx264.')
+
+    parser.add_argument('--bitrate',
+                        dest='bitrate',
+                        type=int,
+                        default=8000,
+                        help='Target video bitrate in kbit/s for --two-pass (Default: 8000)')
+
+    parser.add_argument('--probe-cache',
+                        dest='probe_cache',
+                        type=str,
+                        default='',
+                        help='SQLite file caching clip metadata between runs, e.g. ~/.cache/movie-merge/probe.db '
+                             '(Default: .probe_cache.sqlite in the output directory)')
+
+    parser.add_argument('--stall-timeout',
+                        dest='stall_timeout',
+                        type=int,
+                        default=FFMPEG_STALL_TIMEOUT,
+                        help='Seconds ffmpeg may go without writing output before it is killed, '
+                             f'{FFMPEG_STARTUP_STALL_FACTOR} times as long before its first output, '
+                             f'0 disables the check (Default: {FFMPEG_STALL_TIMEOUT})')
+
     parser.add_argument('--dry-run',
                         action='store_true',
                         help='Run in dry-run mode without processing any files')
@@ -102,183 +186,214 @@ def getArguments():
     return args
 
 class Clip:
-    def __init__(self, video_path, threads=1, dry_run=False) -> None:
+    """
+    A video file of a movie. Creating a clip only reads its metadata, materialize() renames the file to its
+    creation date and converts .mts files.
+    """
+    def __init__(self, video_path, threads=1, dry_run=False, probe_cache=None, encoder=None,
+                 stall_timeout=FFMPEG_STALL_TIMEOUT) -> None:
         self.video_path = Path(video_path)
         self.file_name = self.video_path.name
-        self.file_ext = self.video_path.suffix
+        # Stored in lowercase, renamed files get the lowercase extension as well
+        self.file_ext = self.video_path.suffix.lower()
         self.dry_run = dry_run
-        self.resolution = self.get_resolution()
-        self.fps = self.get_fps()
+        self.threads = threads
+        self.encoder = encoder or Encoder()
+        self.stall_timeout = stall_timeout
+        self.probe_cache = probe_cache
+        if probe_cache:
+            self.resolution, self.fps, self.creation_date = probe_cache.get_or_probe(self.video_path, self.probe)
+        else:
+            self.resolution, self.fps, self.creation_date = self.probe()
 
-        self.target_resolution = (1920, 1080)
         self.mts_path = None
-        self.creation_date = extract_datetime(self.video_path)
-        
+        self.original_file_name = None
+
+    def materialize(self):
         self.rename_file()
 
-        if self.file_ext.lower() == '.mts':
-            self.convert_and_move(threads)
-        
-        self.resize_video()
+        if self.file_ext == '.mts':
+            self.convert_and_move()
+
+    def probe(self):
+        return self.get_resolution(), self.get_fps(), self.get_creation_date()
 
     def run_ffmpeg(self, cmd, description):
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        for line in process.stderr:
-            self.process_ffmpeg_log(line)
-        process.wait()
-        if process.returncode != 0:
-            raise RuntimeError(f"Failed {description} for {self.file_name}")
+        # Following ffmpeg's progress is only worth the overhead when debugging
+        self.last_progress_log = 0
+        progress_callback = self.log_progress if log.isEnabledFor(DEBUG) else None
+        run_ffmpeg(cmd, f"{description} for {self.file_name}", progress_callback, self.stall_timeout)
 
     def run_ffmpeg_and_get_output(self, cmd, description):
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        result = run_process(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
         if result.returncode != 0:
-            log.error(f"Failed {description} for {self.file_name}")
+            log.error(f"Failed {description} for {self.file_name}: {result.stderr.strip()}")
             raise RuntimeError(f"Failed {description} for {self.file_name}")
         return result.stdout.strip()
 
-    def process_ffmpeg_log(self, line):
-        line = line.strip()
-        if not line:
-            return
-        
-        if "error" in line.lower():
-            log.error(line)
-        elif "warning" in line.lower():
-            log.warning(line)
-        elif re.match(r"frame=.*fps=.*q=.*size=.*time=.*bitrate=.*speed=.*", line):
-            log.info(line)
-        else:
-            log.debug(line)
+    def log_progress(self, progress):
+        # Log at most once per second, and when ffmpeg is done
+        if progress['progress'] == 'end' or time.monotonic() - self.last_progress_log >= 1:
+            self.last_progress_log = time.monotonic()
+            log.debug(
+                f"{self.file_name}: frame={progress.get('frame')} fps={progress.get('fps')} "
+                f"time={progress.get('out_time')} speed={progress.get('speed')}"
+            )
 
     def get_creation_date(self):
+        creation_time = self.probe_format.get('tags', {}).get('creation_time')
+        if creation_time:
+            try:
+                return datetime.fromisoformat(creation_time)
+            except ValueError:
+                pass
+        # The container has no usable creation_time, fall back to EXIF and the modification time
+        return extract_datetime(self.video_path, probe_metadata=False)
+
+    @cached_property
+    def probe_data(self):
+        # PyAV reads the headers in-process when it is installed, saving the ffprobe process
+        probe = probe_with_pyav(self.video_path)
+        if probe:
+            return probe
+
+        # A single ffprobe call for everything we need from the first video stream and the container
         cmd = [
-            'ffprobe', '-v', 'error', '-show_entries', 'format_tags=creation_time',
-            '-of', 'default=noprint_wrappers=1:nokey=1', str(self.video_path)
+            'ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+            'stream=width,height,avg_frame_rate,r_frame_rate,field_order,duration:format=duration:format_tags=creation_time',
+            '-of', 'json', str(self.video_path)
         ]
-        creation_date = self.run_ffmpeg_and_get_output(cmd, "creation date extraction")
-        return creation_date
+        result = self.run_ffmpeg_and_get_output(cmd, "stream probe")
+
+        try:
+            return json.loads(result)
+        except ValueError as e:
+            log.error(f"Error parsing ffprobe output: {result}")
+            raise ValueError(f"Unexpected output from ffprobe: {result}") from e
+
+    @cached_property
+    def probe_stream(self):
+        try:
+            return self.probe_data['streams'][0]
+        except (KeyError, IndexError) as e:
+            log.error(f"Error parsing ffprobe output: {self.probe_data}")
+            raise ValueError(f"Unexpected stream format from ffprobe: {self.probe_data}") from e
+
+    @property
+    def probe_format(self):
+        return self.probe_data.get('format', {})
 
     def get_resolution(self):
-        cmd = [
-            'ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries',
-            'stream=width,height', '-of', 'csv=p=0', str(self.video_path)
-        ]
-        output = self.run_ffmpeg_and_get_output(cmd, "resolution extraction")
-        
+        stream = self.probe_stream
         try:
-            # Split the output into lines and find the first non-empty line
-            lines = output.splitlines()
-            for line in lines:
-                # Remove whitespace and skip empty lines
-                line = line.strip()
-                if line:
-                    # Attempt to parse the first non-empty line as resolution
-                    width, height = map(int, line.split(','))
-                    return width, height
-
-            raise ValueError(f"No valid resolution found in ffprobe output: {output}")
-        except ValueError as ve:
-            # Log the error and re-raise with more context if needed
-            log.error(f"Error parsing resolution from ffprobe output: {output}")
-            raise ve
+            return int(stream['width']), int(stream['height'])
+        except (ValueError, KeyError) as e:
+            log.error(f"Error parsing resolution from ffprobe output: {stream}")
+            raise ValueError(f"No valid resolution found in ffprobe output: {stream}") from e
 
-    def get_fps(self):
-        cmd = [
-            'ffprobe', '-v', 'error', '-select_streams', 'v:0',
-            '-show_entries', 'stream=r_frame_rate', '-of', 'json', str(self.video_path)
-        ]
-        result = self.run_ffmpeg_and_get_output(cmd, "FPS extraction")
+    def is_interlaced(self):
+        # Streams with an unknown field order are treated as interlaced, deinterlacing them is the safe choice
+        return self.probe_stream.get('field_order', 'unknown') != 'progressive'
 
+    def get_fps(self):
+        stream = self.probe_stream
         try:
-            # Parse the JSON output
-            result_json = json.loads(result)
-            r_frame_rate = result_json['streams'][0]['r_frame_rate']
-            
-            # Calculate the FPS from the fraction
-            num, denom = map(int, r_frame_rate.split('/'))
+            # Calculate the FPS from the fraction. The average rate is reliable for variable frame rate phone
+            # clips where r_frame_rate is often a timebase, it is 0/0 when unknown though.
+            frame_rate = stream.get('avg_frame_rate', '0/0')
+            if frame_rate.startswith('0/') or frame_rate.endswith('/0'):
+                frame_rate = stream['r_frame_rate']
+            num, denom = map(int, frame_rate.split('/'))
             fps = num / denom
-            
-            # Safely round to the nearest integer
-            rounded_fps = round(fps)
-            
-            return rounded_fps
-        except (ValueError, KeyError, IndexError, ZeroDivisionError) as e:
-            log.error(f"Error parsing FPS from ffprobe output: {result}")
-            raise ValueError(f"Unexpected FPS format from ffprobe: {result}") from e
-
-    def resize_video(self):
-        if self.resolution == self.target_resolution:
-            log.debug(f"{self.file_name} already at target resolution.")
-            return
-
-        if self.dry_run:
-            log.info(f"[DRY RUN] Would resize {self.file_name} to {self.target_resolution}")
-            return
 
-        resized_path = self.video_path.with_name(f"resized_{self.file_name}")
-        cmd = [
-            'ffmpeg', '-i', str(self.video_path),
-            '-vf', f'scale={self.target_resolution[0]}:{self.target_resolution[1]}:force_original_aspect_ratio=decrease',
-            '-c:a', 'copy', str(resized_path)
-        ]
-        self.run_ffmpeg(cmd, "resizing")
-        self.video_path = resized_path
+            # Safely round to the nearest integer
+            return round(fps)
+        except (ValueError, KeyError, ZeroDivisionError) as e:
+            log.error(f"Error parsing FPS from ffprobe output: {stream}")
+            raise ValueError(f"Unexpected FPS format from ffprobe: {stream}") from e
 
-    def convert_and_move(self, threads):
+    def convert_and_move(self):
         if self.dry_run:
             log.info(f"[DRY RUN] Would convert {self.file_name} to .mp4")
             return
 
         log.info(f"Converting {self.file_name} to .mp4...")
         mp4_path = self.video_path.with_suffix('.mp4')
-        cmd = [
-            'ffmpeg', '-y', '-i', str(self.video_path), '-vf', 'yadif',
-            '-c:v', 'libx264', '-c:a', 'aac', '-threads', str(threads),
+        # Normalize to the pipeline's output format so the converted clip can be joined by stream copy later.
+        # Deinterlacing and scaling run in the same pass as the encode. Only downscale to the target resolution,
+        # the frame rate is left to yadif as interlaced streams often report their field rate.
+        width, height = fit_resolution(*self.resolution)
+        # Progressive clips skip the deinterlace, it is a full extra pass over every frame
+        deinterlace = self.is_interlaced()
+        log.debug(f"{self.file_name} is {'interlaced' if deinterlace else 'progressive'}")
+        output_args = [
+            '-map', '0:v:0', '-map', '0:a:0?',
+            '-c:a', 'aac', '-movflags', '+faststart', '-write_tmcd', '0', '-threads', str(self.threads),
             str(mp4_path)
         ]
-        try:
-            self.run_ffmpeg(cmd, "conversion")
-        except RuntimeError as e:
-            log.error(f"Failed to convert {self.file_name} to .mp4.")
-            raise e
+        converted = False
+        if self.encoder.cuda_pipeline:
+            # Decode, deinterlace, scale and encode without copying the frames out of GPU memory
+            cmd = [
+                'ffmpeg', '-y', *self.encoder.input_args(hw_frames=True), '-i', str(self.video_path),
+                '-vf', f"{'yadif_cuda,' if deinterlace else ''}scale_cuda={width}:{height}:format=yuv420p",
+                *self.encoder.codec_args(hw_frames=True), *output_args
+            ]
+            try:
+                self.run_ffmpeg(cmd, "conversion on the GPU")
+                converted = True
+            except RuntimeError:
+                log.warning(f"Converting {self.file_name} on the GPU failed, retrying with CPU filters.")
+
+        if not converted:
+            cmd = [
+                'ffmpeg', '-y', *self.encoder.input_args(), '-i', str(self.video_path),
+                *self.encoder.args(f"{'yadif,' if deinterlace else ''}scale={width}:{height}"), *output_args
+            ]
+            try:
+                self.run_ffmpeg(cmd, "conversion")
+            except RuntimeError as e:
+                log.error(f"Failed to convert {self.file_name} to .mp4.")
+                raise e
         self.file_ext = '.mp4'
+        self.resolution = (width, height)
         self.move_mts_to_subdir()
         self.video_path = mp4_path
 
     def move_mts_to_subdir(self):
         mts_path = self.video_path
 
-        dir_path = mts_path.parent
-        processed_mts_dir = dir_path / "ProcessedClips"
-        os.makedirs(processed_mts_dir, exist_ok=True)
-
-        new_path = processed_mts_dir / mts_path.name
+        # The ProcessedClips directory is created once per directory by get_video_files
+        new_path = mts_path.parent / "ProcessedClips" / mts_path.name
         try:
-            shutil.move(mts_path, new_path)
+            # A rename within the same filesystem is atomic, only copy when crossing filesystems
+            os.replace(mts_path, new_path)
         except OSError as e:
-            raise RuntimeError(f"Failed to move file from {mts_path} to {new_path}.") from e
+            if e.errno != errno.EXDEV:
+                raise RuntimeError(f"Failed to move file from {mts_path} to {new_path}.") from e
+            try:
+                shutil.move(mts_path, new_path)
+            except OSError as e:
+                raise RuntimeError(f"Failed to move file from {mts_path} to {new_path}.") from e
         self.mts_path = new_path
 
     def rename_file(self):
-        self.ensure_csv_exists()
-        if not re.match(r"^\d{4}-\d{2}-\d{2}_\d{2}-\d{2}", self.file_name):
+        if not renamed_file_pattern.match(self.file_name):
             log.debug(f"Original file path before renaming: {self.video_path}")
             creation_date = self.creation_date.strftime("%Y-%m-%d_%H-%M")
-            new_file_name = f"{creation_date}{self.file_ext.lower()}"
+            new_file_name = f"{creation_date}{self.file_ext}"
             new_file_path = self.video_path.with_name(new_file_name)
-            if self.file_ext.isupper():  # Make sure it is lowercase
-                self.file_ext = self.file_ext.lower()
 
             if self.dry_run:
                 log.info(f"[DRY RUN] Would rename {self.file_name} to {new_file_name}")
             else:
-                # Save original filename to CSV
-                csv_path = self.video_path.parent / "original_filenames.csv"
-                with open(csv_path, 'a', newline='') as csvfile:
-                    writer = csv.writer(csvfile)
-                    writer.writerow([self.file_name, new_file_name])
-
+                old_file_path = self.video_path.resolve()
                 os.rename(self.video_path, new_file_path)
+                if self.probe_cache:
+                    # Keep the probe cached under the name the next run finds the file by
+                    self.probe_cache.rename(old_file_path, new_file_path)
+                # Written to original_filenames.csv by save_original_filenames
+                self.original_file_name = self.file_name
 
                 log.info(f"Renamed file {self.file_name} to {new_file_name}")
                 log.debug(f"File path after renaming: {new_file_path}")
@@ -286,13 +401,6 @@ class Clip:
             self.video_path = Path(new_file_path)
             self.file_name = new_file_name
     
-    def ensure_csv_exists(self):
-        csv_path = self.video_path.parent / "original_filenames.csv"
-        if not csv_path.exists():
-            with open(csv_path, 'w', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow(["Original Filename", "New Filename"])
-
     def video_path_str(self):
         return str(self.video_path)
 
@@ -302,27 +410,119 @@ class Clip:
     def output_data(self):
         return { "video_path": f"{self.video_path}", "file_name": f"{self.file_name}", "file_ext": f"{self.file_ext}", "resolution": f"{self.resolution}", "fps": f"{self.fps}", "mts_path": f"{self.mts_path}"}
 
-def get_video_files(sub_directory, threads):
+def save_original_filenames(directory, clips):
+    """Appends the original names of renamed clips to the directory's original_filenames.csv in a single write."""
+    rows = [[clip.original_file_name, clip.file_name] for clip in clips if clip.original_file_name]
+    if not rows:
+        return
+    csv_path = directory / "original_filenames.csv"
+    write_header = not csv_path.exists()
+    with open(csv_path, 'a', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        if write_header:
+            writer.writerow(["Original Filename", "New Filename"])
+        writer.writerows(rows)
+
+def get_video_files(sub_directory, threads, probe_cache=None, encoder=None, conversions=1,
+                    stall_timeout=FFMPEG_STALL_TIMEOUT):
     log.debug("Gathering video files")
     video_files_tmp = get_video_files_in_directory(sub_directory)
+    if not video_files_tmp:
+        return []
+
+    # Probing is independent per file and spends its time waiting on ffprobe, probe all files concurrently
+    workers = min(32, len(video_files_tmp), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        video_files = list(executor.map(
+            lambda file: Clip(
+                video_path=file, threads=threads, probe_cache=probe_cache, encoder=encoder, stall_timeout=stall_timeout
+            ),
+            video_files_tmp
+        ))
+
+    if any(clip.file_ext == '.mts' for clip in video_files):
+        # The parent always exists, a single mkdir is enough
+        (sub_directory / "ProcessedClips").mkdir(exist_ok=True)
+
+    # Every .mts conversion is a separate ffmpeg process, run as many at once as the cores left to this job allow
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, conversions)) as executor:
+            list(executor.map(Clip.materialize, video_files))
+    finally:
+        # Record the renames even when a conversion failed, the probes are stored under the renamed paths
+        save_original_filenames(sub_directory, video_files)
+        if probe_cache:
+            probe_cache.flush()
 
-    video_files = []
-    for file in video_files_tmp:
-        obj = Clip(video_path=file, threads=threads)
-        video_files.append(obj)
+    sorted_video_files = sort_clips_by_date(video_files)
 
+    for obj in sorted_video_files:
         # One-line INFO summary for each clip
         mts_info = f", Converted .mts to .mp4, Moved original to {obj.mts_path}" if obj.mts_path else ""
         log.info(f"Processed clip: {obj.file_name}, Path: {obj.video_path}, Resolution: {obj.resolution}, FPS: {obj.fps}{mts_info}")
+        if log.isEnabledFor(DEBUG):
+            log.debug(obj.output_data())
 
-    sorted_video_files = sort_clips_by_date(video_files)
+    return sorted_video_files
 
-    for obj in sorted_video_files:
-        log.debug(obj.output_data())
+def render_movie(all_clips, nice_title, filmed_date, output_file_path, work_dir, output_fps, threads, encoder, conversions=1,
+                 probe_cache=None, stall_timeout=FFMPEG_STALL_TIMEOUT):
+    """
+    Renders the collected clips into the final movie. The movie starts with a title card, and chapter titles
+    become title cards as well, all matching the first video file. When all segments share the same streams
+    they are joined by stream copy, otherwise all segments are re-encoded in a single pass, or split over several
+    ffmpeg processes when the job has cores to spare.
+    """
+    # Every segment is probed exactly once, the first video file doubles as the title card reference.
+    # Video files are looked up in the probe cache, title cards are new every time.
+    def probe_video_file(clip):
+        if probe_cache:
+            return probe_cache.get_or_probe_segment(clip, lambda: probe_segment(clip))
+        return probe_segment(clip)
+
+    # Probing waits on ffprobe, probe all video files concurrently like get_video_files does
+    video_files = [clip for clip in all_clips if isinstance(clip, Path)]
+    workers = min(32, len(video_files), os.cpu_count() or 1) or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        probes = dict(zip(video_files, executor.map(probe_video_file, video_files)))
+    if probe_cache:
+        probe_cache.flush()
+    reference = next((clip for clip in all_clips if isinstance(clip, Path)), None)
+    if reference:
+        reference_signature = probes[reference][0]
+    else:
+        reference_signature = (None, *TARGET_RESOLUTION, output_fps, None, None, None, None, 0)
 
-    return sorted_video_files
+    segments = []
+    for index, clip in enumerate([nice_title, *all_clips]):
+        if isinstance(clip, Path):
+            segments.append(clip)
+        else:
+            card_path = work_dir / f"title_card_{index:04d}.mp4"
+            create_title_card(clip, card_path, reference_signature, encoder, threads, stall_timeout)
+            probes[card_path] = probe_segment(card_path)
+            segments.append(card_path)
+
+    signatures = [probes[segment][0] for segment in segments]
+    if can_stream_copy(signatures):
+        log.info(f"Writing file {output_file_path} by stream copy.")
+        concatenate_clips(segments, output_file_path, nice_title, filmed_date, stall_timeout)
+    else:
+        log.info(f"Writing file {output_file_path}. Clip formats differ, re-encoding with {encoder} at {output_fps} FPS.")
+        durations = [probes[segment][1] for segment in segments]
+        if conversions > 1:
+            encode_clips_in_parallel(
+                segments, signatures, durations, output_file_path, output_fps, nice_title, filmed_date, encoder, threads,
+                work_dir, conversions, stall_timeout
+            )
+        else:
+            encode_clips(
+                segments, signatures, durations, output_file_path, output_fps, nice_title, filmed_date, encoder, threads,
+                stall_timeout
+            )
 
-def process_directory(sub_directory, output_directory, threads, dry_run):
+def process_directory(sub_directory, output_directory, threads, dry_run, probe_cache=None, encoder=None, conversions=1,
+                      stall_timeout=FFMPEG_STALL_TIMEOUT):
     # Process the root directory
     title, nice_title, filmed_date, filmed_year = get_directory_info(sub_directory)
     if nice_title:
@@ -341,53 +541,46 @@ def process_directory(sub_directory, output_directory, threads, dry_run):
                 log.info(f"[DRY RUN] Would process {nice_title}")
                 return
 
-            # Collect all video files and intro clips for chapters
+            # Collect all video files and intro clips for chapters. Files are kept as paths,
+            # chapter titles as strings that get rendered to title cards.
             all_clips = []
 
             # Process video files in the root directory
-            root_video_files = get_video_files(sub_directory, threads)
-            for video_file in root_video_files:
-                try:
-                    all_clips.append(VideoFileClip(video_file.video_path_str()))
-                except Exception as e:
-                    log.error(f"Error processing video file {video_file.file_name}: {str(e)}")
+            root_video_files = get_video_files(sub_directory, threads, probe_cache, encoder, conversions, stall_timeout)
+            all_clips.extend(video_file.video_path for video_file in root_video_files)
 
-            # Process subdirectories as chapters
-            for entry in sub_directory.iterdir():
-                if entry.is_dir():
+            # Process subdirectories as chapters, in name order so dated chapters follow each other
+            with os.scandir(sub_directory) as entries:
+                directory_entries = sorted(entries, key=attrgetter('name'))
+            for directory_entry in directory_entries:
+                entry = Path(directory_entry.path)
+                if directory_entry.is_dir():
 
                     log.debug(f"Processing directory entry {entry}")
-                    # chapter_title, chapter_nice_title, chapter_filmed_date, _ = get_directory_info(entry)
                     chapter_title, chapter_nice_title, chapter_filmed_date, chapter_year = get_directory_info(entry)
 
                     if chapter_title:
-                        chapter_intro_clip = create_title_card(chapter_nice_title)
-                        all_clips.append(chapter_intro_clip)
+                        all_clips.append(chapter_nice_title)
 
                         # Get video files from the chapter subdirectory
-                        chapter_video_files = get_video_files(entry, threads)
-                        for video_file in chapter_video_files:
-                            all_clips.append(VideoFileClip(video_file.video_path_str()))
+                        chapter_video_files = get_video_files(
+                            entry, threads, probe_cache, encoder, conversions, stall_timeout
+                        )
+                        all_clips.extend(video_file.video_path for video_file in chapter_video_files)
                     else:
                         log.warning(f"No valid title or date found for chapter directory {entry}. Skipping...")
                 else:
                     log.debug(f"Skipping non-directory entry {entry}")
 
             if all_clips:
-                # Create the final movie
-                first_clip = burn_title_into_clip(all_clips[0], nice_title)  # Create a title card for the intro clip
-                final_clip = concatenate_clips(all_clips[1:], first_clip, nice_title)  # Pass all clips except the first one
+                encoder = encoder or Encoder()
                 output_fps = root_video_files[0].fps if root_video_files else 24  # Fallback FPS
-                log.info(f"Writing file {final_output_file_path}. FPS: {output_fps}")
-                write_output_file(
-                    final_clip,
-                    str(temp_output_file_path),
-                    output_fps,
-                    threads,
-                    nice_title,
-                    filmed_date
-                )
-                temp_output_file_path.rename(final_output_file_path)
+                with tempfile.TemporaryDirectory(dir=output_directory) as work_dir:
+                    render_movie(
+                        all_clips, nice_title, filmed_date, temp_output_file_path, Path(work_dir), output_fps, threads, encoder,
+                        conversions, probe_cache, stall_timeout
+                    )
+                os.replace(temp_output_file_path, final_output_file_path)
             else:
                 log.warning(f"No video files found for movie '{nice_title}'. Skipping...")
         except Exception as e:
@@ -396,6 +589,19 @@ def process_directory(sub_directory, output_directory, threads, dry_run):
     else:
         log.error(f"No title found for root directory {sub_directory}. Skipping...")
 
+# Each worker process opens its own connection to the probe cache
+worker_probe_cache = None
+
+def init_worker(probe_cache_path, log_level):
+    global worker_probe_cache
+    log.setLevel(log_level)
+    worker_probe_cache = ProbeCache(probe_cache_path) if probe_cache_path else None
+
+def process_directory_in_worker(sub_directory, output_directory, threads, dry_run, encoder, conversions, stall_timeout):
+    process_directory(
+        sub_directory, output_directory, threads, dry_run, worker_probe_cache, encoder, conversions, stall_timeout
+    )
+
 def main():
     arguments = getArguments()
     if arguments.log_level in log_levels.keys():
@@ -425,15 +631,69 @@ def main():
     log.info(f"Output Directory: {output_directory}")
     log.info(f"Years to Process: {', '.join(sorted_years_list)}")
     log.info(f"Number of Threads: {threads}")
-
-    for year_directory in input_directory.iterdir():
-        if year_directory.is_dir() and year_directory.name in sorted_years_list:
-            for sub_directory in year_directory.iterdir():
-                if sub_directory.is_dir():
-                    try:
-                        process_directory(sub_directory, output_directory, threads, dry_run)
-                    except Exception as e:
-                        log.error(f"Error processing directory {sub_directory}: {e}")
+    check_ffmpeg_build()
+    encoder = Encoder.detect(arguments.encoder, arguments.preset, arguments.crf, arguments.hwaccel)
+    if arguments.two_pass:
+        if encoder.name == 'libx264':
+            encoder.bitrate = arguments.bitrate
+        else:
+            log.warning(f"Two-pass encoding is only supported with libx264, encoding with {encoder} in a single pass.")
+    log.info(f"Encoder: {encoder}, Preset: {encoder.preset}, CRF: {encoder.crf}, Hardware Decoder: {encoder.hwaccel or 'none'}")
+    if encoder.bitrate:
+        log.info(f"Two-Pass Bitrate: {encoder.bitrate} kbit/s")
+
+    # scandir reuses the file type from the directory listing instead of a stat() per entry
+    years = set(sorted_years_list)
+    sub_directories = []
+    with os.scandir(input_directory) as year_entries:
+        for year_entry in year_entries:
+            if year_entry.is_dir() and year_entry.name in years:
+                with os.scandir(year_entry.path) as sub_entries:
+                    for sub_entry in sub_entries:
+                        if sub_entry.is_dir():
+                            sub_directories.append(Path(sub_entry.path))
+
+    # Every movie is independent, process several at once but keep jobs x ffmpeg threads close to the number of cores
+    cpu_count = physical_cpu_count()
+    # -t 0 lets every ffmpeg pick its own thread count, which already uses all cores
+    jobs = arguments.jobs or (max(1, cpu_count // threads) if threads else 1)
+    # No point in starting workers that would never get a directory
+    jobs = max(1, min(jobs, len(sub_directories)))
+    if encoder.max_sessions and not arguments.jobs:
+        jobs = min(jobs, encoder.max_sessions)
+    job_threads = max(1, min(threads, cpu_count // jobs)) if threads else 0
+    # Cores not used by the jobs' ffmpeg threads go to converting several clips of a movie at once
+    conversions = max(1, cpu_count // (jobs * job_threads)) if job_threads else 1
+    if encoder.max_sessions:
+        # Keep the encodes running at once within what the hardware encoder allows
+        conversions = max(1, min(conversions, encoder.max_sessions // jobs))
+    log.info(f"Parallel Jobs: {jobs}, Threads per Job: {job_threads}, Conversions per Job: {conversions}")
+
+    if dry_run:
+        # A dry run probes nothing and must not write to the output directory
+        probe_cache_path = None
+    elif arguments.probe_cache:
+        probe_cache_path = Path(arguments.probe_cache).expanduser()
+        probe_cache_path.parent.mkdir(parents=True, exist_ok=True)
+    else:
+        probe_cache_path = output_directory / ".probe_cache.sqlite"
+    log.info(f"Probe Cache: {probe_cache_path or 'none'}")
+    # Imported here so importing this module, --help and argument errors do not load multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    worker_args = (probe_cache_path, log_level)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=worker_args) as executor:
+        futures = {
+            executor.submit(
+                process_directory_in_worker, sub_directory, output_directory, job_threads, dry_run, encoder, conversions,
+                arguments.stall_timeout
+            ): sub_directory
+            for sub_directory in sub_directories
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                log.error(f"Error processing directory {futures[future]}: {e}")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,41 +1,236 @@
 ### tools.py
 
+import json
+import os
+import platform
 import re
+import shutil
+import sqlite3
 import subprocess
+import tempfile
+import threading
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from logging import getLogger
+from functools import lru_cache
+from logging import DEBUG, getLogger
+from operator import attrgetter
+from pathlib import Path
 
 import exifread
-from moviepy.editor import CompositeVideoClip, TextClip, concatenate_videoclips
+
+try:
+    import av
+except ImportError:  # PyAV is optional, clips are probed with ffprobe without it
+    av = None
 
 log = getLogger('movie-merge')
 
-def extract_datetime(file_path):
+# Files picked up as clips, compared in lowercase
+VIDEO_EXTENSIONS = frozenset({'.mp4', '.mkv', '.avi', '.mov', '.wmv', '.mts'})
+
+# Resolution every movie is scaled down to when clips have to be re-encoded
+TARGET_RESOLUTION = (1920, 1080)
+
+# Titles are drawn with ffmpeg's drawtext, the font is looked up through fontconfig
+TITLE_FONT = 'DejaVu Sans'
+TITLE_DURATION = 5  # Duration in seconds
+TITLE_FADE = 2  # Duration in seconds
+
+# Movie and chapter directories are named after the date they were filmed with an optional title, e.g.
+# "2017-01-01 - Skiing". Anything after a second " - " is not part of the title.
+DIRECTORY_NAME_PATTERN = re.compile(r'^\s*((\d{4})-\d{2}-\d{2})\s*(?: - (.*?)(?: - .*)?)?\Z', re.DOTALL)
+
+# Device names and characters (and dots) that are not allowed in file names on Windows, each replaced with an
+# underscore in a single pass
+RESERVED_NAMES = re.compile(r'(?i)\b(?:con|prn|aux|nul|com[0-9]|lpt[0-9])\b|[/\\?%*:|"<>.]')
+
+# ffmpeg is killed when its output has not moved for this long, e.g. when it hangs on a corrupt file. 0 disables it.
+FFMPEG_STALL_TIMEOUT = 60  # Duration in seconds
+# Before its first output ffmpeg opens the inputs and fills the encoder lookahead, it gets this many stall timeouts
+FFMPEG_STARTUP_STALL_FACTOR = 10
+
+@lru_cache(maxsize=None)
+def find_executable(name):
+    return shutil.which(name) or name
+
+def start_process(cmd, **kwargs):
+    """
+    Starts ffmpeg/ffprobe. CPython only spawns with the fast posix_spawn() instead of fork()/exec() when the
+    executable has a full path and file descriptors are left open, which is safe since Python creates them
+    non-inheritable.
+    """
+    return subprocess.Popen([find_executable(cmd[0]), *cmd[1:]], close_fds=False, **kwargs)
+
+def run_process(cmd, **kwargs):
+    """Runs ffmpeg/ffprobe to completion, spawned the same way as start_process()."""
+    return subprocess.run([find_executable(cmd[0]), *cmd[1:]], close_fds=False, **kwargs)
+
+class ProbeCache:
+    """
+    Caches probed clip metadata and stream signatures in a sqlite database keyed by (path, mtime, size).
+    Unchanged files skip ffprobe entirely on later runs; a changed mtime or size is a cache miss.
+    New results are kept in memory until flush() writes them in a single transaction.
+    """
+    # Raised whenever stored values change meaning, tables of an older version are dropped and probed again
+    SCHEMA_VERSION = 5
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.pending = []
+        # Several worker processes share the database, wait for their writes instead of failing
+        self.connection = sqlite3.connect(str(db_path), timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            # Worker processes open the database at the same time, only one of them may drop the old tables
+            self.connection.execute('BEGIN IMMEDIATE')
+            if self.connection.execute('PRAGMA user_version').fetchone()[0] < self.SCHEMA_VERSION:
+                self.connection.execute('DROP TABLE IF EXISTS probe')
+                self.connection.execute('DROP TABLE IF EXISTS segment')
+                self.connection.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS probe ('
+                'path TEXT, mtime INTEGER, size INTEGER, width INT, height INT, fps INTEGER, creation TEXT, '
+                'PRIMARY KEY(path, mtime, size))'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS segment ('
+                'path TEXT, mtime INTEGER, size INTEGER, signature TEXT, duration REAL, '
+                'PRIMARY KEY(path, mtime, size))'
+            )
+
+    @staticmethod
+    def get_key(file_path):
+        stat = file_path.stat()
+        return str(file_path.resolve()), stat.st_mtime_ns, stat.st_size
+
+    def get_or_probe(self, file_path, probe):
+        """
+        Returns ((width, height), fps, creation_date) for the file.
+        Calls probe() on a cache miss and stores its result.
+        """
+        key = self.get_key(file_path)
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT width, height, fps, creation FROM probe WHERE path=? AND mtime=? AND size=?', key
+            ).fetchone()
+        if row:
+            width, height, fps, creation = row
+            log.debug(f"Probe cache hit for {file_path}")
+            return (width, height), fps, datetime.fromisoformat(creation)
+
+        resolution, fps, creation_date = probe()
+        with self.lock:
+            self.pending.append(('probe', (*key, resolution[0], resolution[1], fps, creation_date.isoformat())))
+        return resolution, fps, creation_date
+
+    def get_or_probe_segment(self, file_path, probe):
+        """
+        Returns the (signature, duration) of probe_segment for the file.
+        Calls probe() on a cache miss and stores its result.
+        """
+        key = self.get_key(file_path)
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT signature, duration FROM segment WHERE path=? AND mtime=? AND size=?', key
+            ).fetchone()
+        if row:
+            log.debug(f"Segment probe cache hit for {file_path}")
+            return tuple(json.loads(row[0])), row[1]
+
+        signature, duration = probe()
+        with self.lock:
+            self.pending.append(('segment', (*key, json.dumps(signature), duration)))
+        return signature, duration
+
+    def rename(self, old_path, new_path):
+        """
+        Moves the unflushed results of a renamed file to its new path, renaming keeps the mtime and size.
+        old_path has to be resolved before the rename.
+        """
+        old_path, new_path = str(old_path), str(new_path.resolve())
+        with self.lock:
+            self.pending = [(table, (new_path, *row[1:]) if row[0] == old_path else row) for table, row in self.pending]
+
+    def flush(self):
+        """Stores the results probed since the last flush in one transaction."""
+        with self.lock, self.connection:
+            for table, row in self.pending:
+                # Drop stale entries for the same path before storing the new one
+                self.connection.execute(f'DELETE FROM {table} WHERE path=?', (row[0],))
+                self.connection.execute(f'INSERT INTO {table} VALUES ({", ".join("?" * len(row))})', row)
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+def probe_with_pyav(file_path):
+    """
+    Reads the fields of Clip's ffprobe call in-process with PyAV and returns them in ffprobe's JSON layout.
+    Returns None when PyAV is not installed or cannot read the file, so the caller can fall back to ffprobe.
+    """
+    if av is None:
+        return None
+
+    def format_rate(rate):
+        return f'{rate.numerator}/{rate.denominator}' if rate else '0/0'
+
+    def format_field_order(field_order):
+        # libavcodec's AVFieldOrder values, named the way ffprobe prints them
+        names = ('unknown', 'progressive', 'tt', 'bb', 'tb', 'bt')
+        return names[field_order] if isinstance(field_order, int) and 0 <= field_order < len(names) else 'unknown'
+
+    try:
+        # Tags are not always UTF-8, strict decoding would fail the whole probe on e.g. a Latin-1 title
+        with av.open(str(file_path), metadata_errors='replace') as container:
+            stream = container.streams.video[0]
+            probe = {
+                'streams': [{
+                    'width': stream.codec_context.width,
+                    'height': stream.codec_context.height,
+                    'avg_frame_rate': format_rate(stream.average_rate),
+                    'r_frame_rate': format_rate(stream.base_rate),
+                    'field_order': format_field_order(getattr(stream.codec_context, 'field_order', None)),
+                }],
+                'format': {'tags': dict(container.metadata)},
+            }
+            if container.duration is not None:
+                probe['format']['duration'] = str(container.duration / av.time_base)
+            return probe
+    except (av.error.FFmpegError, IndexError, UnicodeDecodeError) as e:
+        log.debug(f"PyAV could not probe {file_path}: {e}")
+        return None
+
+def extract_datetime(file_path, probe_metadata=True):
     """
     Extracts the datetime from the metadata of a file.
     First attempts to use the file's creation date from metadata, then falls back to EXIF data.
+    Callers that already probed the container metadata can skip that step with probe_metadata=False.
     """
     def get_creation_date_from_metadata(file_path):
         cmd = [
             'ffprobe', '-v', 'error', '-select_streams', 'v:0',
             '-show_entries', 'format_tags=creation_time', '-of', 'default=noprint_wrappers=1:nokey=1', str(file_path)
         ]
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        if result.returncode == 0 and result.stdout.strip():
-            return result.stdout.strip()
+        # The output is a single ASCII timestamp or nothing, only decode it when it is there
+        result = run_process(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        creation_time = result.stdout.strip()
+        if result.returncode == 0 and creation_time:
+            return creation_time.decode('ascii', 'replace')
         return None
 
     def get_creation_date_from_exif(file_path):
         with open(file_path, 'rb') as f:
-            tags = exifread.process_file(f)
+            # Only the date tags are needed, skip maker notes and thumbnails and stop reading once the date is found
+            tags = exifread.process_file(f, stop_tag='DateTimeOriginal', details=False)
             date_tag = tags.get('EXIF DateTimeOriginal') or tags.get('Image DateTime')
             if date_tag:
                 return date_tag.values
         return None
 
     # Attempt to extract creation date from metadata
-    creation_date = get_creation_date_from_metadata(file_path)
+    creation_date = get_creation_date_from_metadata(file_path) if probe_metadata else None
     if creation_date:
         try:
             return datetime.fromisoformat(creation_date)
@@ -56,11 +251,8 @@ def extract_datetime(file_path):
 def sanitize_filename(title):
     """Sanitize the filename by replacing reserved words and characters."""
     
-    # Strip out reserved words for Windows
-    title = re.sub(r'(?i)\b(con|prn|aux|nul|com[0-9]|lpt[0-9])\b', '_', title)
-
-    # Replace reserved characters with underscore
-    title = re.sub(r'[\/\\\?\%\*\:\|\\"\<\>\.]', '_', title)
+    # Replace reserved words and characters with underscore
+    title = RESERVED_NAMES.sub('_', title)
 
     # Remove leading/trailing dots and spaces
     title = title.strip('. ')
@@ -68,105 +260,536 @@ def sanitize_filename(title):
     return title
 
 def get_video_files_in_directory(directory):
-    extensions = ['.mp4', '.mkv', '.avi', '.mov', '.wmv', '.mts']
-    return sorted([file for file in directory.iterdir() if str(file.suffix).lower() in extensions])
+    # scandir reuses the file type from the directory listing instead of a stat() per entry
+    with os.scandir(directory) as entries:
+        video_entries = [
+            entry for entry in entries
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in VIDEO_EXTENSIONS
+        ]
+    # All entries share the directory, sorting on the names avoids comparing Path objects part by part
+    video_entries.sort(key=attrgetter('name'))
+    return [Path(entry.path) for entry in video_entries]
 
 def get_directory_info(sub_directory):
     # Skip if directory name is "ProcessedClips"
     if sub_directory.name == "ProcessedClips":
         return None, None, None, None
 
-    # Extract the last component of the directory name
-    dir_name = sub_directory.name
-    
-    # Attempt to split the directory name by ' - ' to separate the date and title
-    parts = dir_name.split(' - ')
-    log.debug(f"Parts: {parts}")
-    
-    # The first part should be the date
-    filmed_date = parts[0].strip()
-    log.debug(f"Filmed date: {filmed_date}")
-    
-    # Extract the year from the date
-    filmed_year = filmed_date.split('-')[0]
-    log.debug(f"Filmed year: {filmed_year}")
-    
-    # Validate the date format (basic validation assuming YYYY-MM-DD)
-    if not re.match(r'^\d{4}-\d{2}-\d{2}$', filmed_date):
+    # A single match gives the date, the year and the optional title
+    match = DIRECTORY_NAME_PATTERN.match(sub_directory.name)
+    if not match:
         return None, None, None, None
-    
+    filmed_date, filmed_year, raw_title = match.groups()
+
     # If no title is provided, set both title and nice_title to filmed_date
-    if len(parts) == 1:
+    if raw_title is None:
         title = filmed_date
         nice_title = filmed_date
-        log.debug(f"Title: {title}, Nice title: {nice_title}")
     else:
-        title = sanitize_filename(parts[1])
+        title = sanitize_filename(raw_title)
         nice_title = f"{filmed_date} - {title}"
-        log.debug(f"Title: {title}, Nice title: {nice_title}")
-    
+    log.debug(f"Filmed date: {filmed_date}, Filmed year: {filmed_year}, Title: {title}, Nice title: {nice_title}")
+
     return title, nice_title, filmed_date, filmed_year
 
-def create_title_card(title):
-    log.info("Creating title card for new chapter with title: " + title)
+def escape_filter_value(value):
+    """Escapes a value for the filter option parser and then for the filter graph parser."""
+    for char in ('\\', "'", ':'):
+        value = value.replace(char, '\\' + char)
+    for char in ('\\', "'", '[', ']', ',', ';'):
+        value = value.replace(char, '\\' + char)
+    return value
+
+def get_title_filter(title):
+    """
+    Returns a drawtext filter showing the title centered for TITLE_DURATION seconds.
+    The text fades in over the first and out over the last TITLE_FADE seconds.
+    """
+    # drawtext expands % sequences and backslashes in the text itself
+    text = title.replace('\\', '\\\\').replace('%', '\\%')
+    alpha = f'max(0,min(1,min(t/{TITLE_FADE},({TITLE_DURATION}-t)/{TITLE_FADE})))'
+    options = {
+        'font': TITLE_FONT,
+        'text': text,
+        'fontsize': '70',
+        'fontcolor': 'white',
+        'x': '(w-text_w)/2',
+        'y': '(h-text_h)/2',
+        'enable': f'between(t,0,{TITLE_DURATION})',
+        'alpha': alpha,
+    }
+    return 'drawtext=' + ':'.join(f'{key}={escape_filter_value(value)}' for key, value in options.items())
 
+def create_title_card(title, output_path, signature, encoder, threads, stall_timeout=FFMPEG_STALL_TIMEOUT):
+    """Renders a movie or chapter title card matching the streams of the given signature, so it can be stream copied."""
+    log.info("Creating title card with title: " + title)
+    _, width, height, frame_rate, _, audio_codec, sample_rate, channels, _ = signature
+    cmd = ['ffmpeg', '-y', '-f', 'lavfi', '-i', f'color=c=black:s={width}x{height}:r={frame_rate}:d={TITLE_DURATION}']
+    if audio_codec:
+        # A silent track with the channel count of the reference, references without audio get a card without audio
+        channel_layout = {1: 'mono', 2: 'stereo'}.get(channels, f'{channels}c') if channels else 'stereo'
+        cmd += ['-f', 'lavfi', '-i', f'anullsrc=channel_layout={channel_layout}:sample_rate={sample_rate or 48000}']
+        audio_args = ['-c:a', 'aac', '-shortest']
+    else:
+        audio_args = ['-an']
+    cmd += [*encoder.args(get_title_filter(title)), *audio_args, '-threads', str(threads), str(output_path)]
     try:
-        txt_clip = TextClip(title, fontsize=70, color='white', font="Arial").set_duration(5)
-        txt_position = ('center', 'center')
-        txt_clip = txt_clip.set_position(txt_position)
+        run_ffmpeg(cmd, f"creating title card for {title}", stall_timeout=stall_timeout)
+    except RuntimeError as e:
+        raise RuntimeError(f"Failed to create title card for {title}.") from e
+
+class Encoder:
+    """
+    The H.264 encoder used for every re-encode, together with the flags selecting its speed/quality tradeoff.
+    Hardware encoders are preferred when available since the encode dominates the runtime.
+    """
+    # Hardware encoders in order of preference
+    HARDWARE_ENCODERS = ('h264_nvenc', 'h264_qsv', 'h264_amf', 'h264_vaapi', 'h264_videotoolbox')
+    # Hardware decoders, auto picks the one belonging to the encoder
+    HWACCELS = {'h264_nvenc': 'cuda', 'h264_qsv': 'qsv', 'h264_vaapi': 'vaapi', 'h264_videotoolbox': 'videotoolbox'}
+    VAAPI_DEVICE = '/dev/dri/renderD128'
+    # Consumer GPUs only allow a few encode sessions at once, more concurrent encodes fail to open the encoder
+    MAX_HARDWARE_SESSIONS = 3
 
-        # Apply fade-in and fade-out effects
-        fade_duration = 2  # Duration in seconds
-        txt_clip = txt_clip.crossfadein(fade_duration).crossfadeout(fade_duration)
+    def __init__(self, name='libx264', preset='veryfast', crf=20, bitrate=None, hwaccel=None):
+        self.name = name
+        self.preset = preset
+        self.crf = crf
+        # Hardware decoder for inputs, decoded frames are downloaded so the filters keep running on the CPU
+        self.hwaccel = hwaccel
+        # Target video bitrate in kbit/s, set to encode the final movie in two passes (libx264 only)
+        self.bitrate = bitrate
 
-        return txt_clip
-    except Exception as e:
-        raise RuntimeError(f"Failed to create title card for {title}.") from e
+    def __str__(self):
+        return self.name
+
+    @property
+    def max_sessions(self):
+        """The number of encodes that can run at the same time, None when only the CPU limits it."""
+        return self.MAX_HARDWARE_SESSIONS if self.name in self.HARDWARE_ENCODERS else None
+
+    @property
+    def cuda_pipeline(self):
+        """True when frames can stay in GPU memory from decoding to encoding, with CUDA filters in between."""
+        return self.name == 'h264_nvenc' and self.hwaccel == 'cuda'
+
+    def input_args(self, hw_frames=False):
+        """
+        Returns the options to put in front of every -i of a file that gets decoded.
+        With hw_frames decoded frames are left in GPU memory for CUDA filters, see cuda_pipeline.
+        """
+        if not self.hwaccel:
+            return []
+        if self.hwaccel == 'vaapi':
+            return ['-hwaccel', 'vaapi', '-hwaccel_device', self.VAAPI_DEVICE]
+        if hw_frames:
+            return ['-hwaccel', self.hwaccel, '-hwaccel_output_format', self.hwaccel]
+        return ['-hwaccel', self.hwaccel]
+
+    def video_filter(self, video_filter=None):
+        """Returns the filter chain with any filters the encoder needs appended, or None."""
+        filters = [video_filter] if video_filter else []
+        if self.name == 'h264_vaapi':
+            # Frames have to be uploaded to the GPU before encoding
+            filters.append('format=nv12,hwupload')
+        return ','.join(filters) or None
 
-def burn_title_into_clip(video_clip, title):
-    log.info("Burning title into first clip")
+    def codec_args(self, hw_frames=False):
+        if self.name == 'h264_nvenc':
+            codec_args = ['-preset', 'p4', '-rc', 'vbr', '-cq', str(self.crf), '-b:v', '0']
+            # GPU frames already have their format set by the CUDA filters
+            if not hw_frames:
+                codec_args += ['-pix_fmt', 'yuv420p']
+        elif self.name == 'h264_qsv':
+            codec_args = ['-preset', self.preset, '-global_quality', str(self.crf), '-pix_fmt', 'nv12']
+        elif self.name == 'h264_amf':
+            codec_args = ['-quality', 'speed', '-rc', 'cqp', '-qp_i', str(self.crf), '-qp_p', str(self.crf), '-pix_fmt', 'yuv420p']
+        elif self.name == 'h264_vaapi':
+            codec_args = ['-vaapi_device', self.VAAPI_DEVICE, '-qp', str(self.crf)]
+        elif self.name == 'h264_videotoolbox':
+            codec_args = ['-q:v', '65', '-pix_fmt', 'yuv420p']
+        else:
+            codec_args = ['-preset', self.preset, '-crf', str(self.crf), '-pix_fmt', 'yuv420p']
+        return ['-c:v', self.name] + codec_args
 
+    def two_pass_args(self, pass_number, passlogfile):
+        """Returns the codec arguments for one pass of a two-pass encode at the target bitrate."""
+        return [
+            '-c:v', self.name, '-preset', self.preset, '-b:v', f'{self.bitrate}k',
+            '-maxrate', f'{self.bitrate * 3 // 2}k', '-bufsize', f'{self.bitrate * 2}k', '-pix_fmt', 'yuv420p',
+            '-pass', str(pass_number), '-passlogfile', str(passlogfile)
+        ]
+
+    def args(self, video_filter=None):
+        """Returns the -vf and codec arguments for an ffmpeg output encoded with this encoder."""
+        video_filter = self.video_filter(video_filter)
+        vf_args = ['-vf', video_filter] if video_filter else []
+        return vf_args + self.codec_args()
+
+    @classmethod
+    def detect(cls, requested='auto', preset='veryfast', crf=20, hwaccel='auto'):
+        """
+        Returns the requested encoder, or for 'auto' the first hardware encoder that can actually encode on this
+        machine. ffmpeg lists encoders it was built with even when the hardware is missing, so each candidate
+        is tried on a single blank frame. Falls back to libx264.
+        hwaccel 'auto' decodes with the hardware of the chosen encoder, 'none' always decodes on the CPU.
+        """
+        encoder = cls._detect_encoder(requested, preset, crf)
+        if hwaccel == 'auto':
+            encoder.hwaccel = cls.HWACCELS.get(encoder.name)
+        elif hwaccel != 'none':
+            encoder.hwaccel = hwaccel
+        return encoder
+
+    @classmethod
+    def _detect_encoder(cls, requested, preset, crf):
+        if requested != 'auto':
+            return cls(requested, preset, crf)
+
+        result = run_process(['ffmpeg', '-hide_banner', '-encoders'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        for name in cls.HARDWARE_ENCODERS:
+            if name not in result.stdout:
+                continue
+            encoder = cls(name, preset, crf)
+            cmd = [
+                'ffmpeg', '-hide_banner', '-v', 'error', '-f', 'lavfi', '-i', 'color=size=256x256:duration=0.1',
+                '-frames:v', '1', *encoder.args(), '-f', 'null', '-'
+            ]
+            if run_process(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+                log.info(f"Using hardware encoder {name}")
+                return encoder
+            log.debug(f"Encoder {name} is listed by ffmpeg but not usable")
+        return cls('libx264', preset, crf)
+
+@lru_cache(maxsize=None)
+def physical_cpu_count():
+    """
+    Returns the number of physical cores, or the number of logical CPUs when it cannot be determined.
+    The encoders gain little from a second hardware thread on the same core, the ffmpeg threads are budgeted per core.
+    """
+    logical = os.cpu_count() or 1
+    cores = set()
     try:
-        txt_clip = TextClip(title, fontsize=70, color='white', font="Arial").set_duration(5)
-        txt_position = ('center', 'center')
-        txt_clip = txt_clip.set_position(txt_position)
+        with open('/proc/cpuinfo') as cpuinfo:
+            physical_id = None
+            for line in cpuinfo:
+                key, _, value = line.partition(':')
+                key = key.strip()
+                if key == 'physical id':
+                    physical_id = value.strip()
+                elif key == 'core id':
+                    cores.add((physical_id, value.strip()))
+    except OSError:
+        pass
+    if not cores and platform.system() == 'Darwin':
+        result = run_process(['sysctl', '-n', 'hw.physicalcpu'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        if result.stdout.strip().isdigit():
+            return max(1, min(int(result.stdout), logical))
+    # ARM kernels do not list core ids
+    return max(1, min(len(cores), logical)) if cores else logical
 
-        # Apply the fade out effect
-        fade_duration = 2  # Duration in seconds
-        txt_clip = txt_clip.crossfadeout(fade_duration)
+def check_ffmpeg_build():
+    """
+    Warns when ffmpeg on an ARM machine was built without NEON, swscale and libx264 then fall back to their much
+    slower C implementations. NEON is enabled by default on aarch64, so only an explicit --disable-neon is reported.
+    """
+    if platform.machine().lower() not in ('aarch64', 'arm64'):
+        return
+    result = run_process(['ffmpeg', '-hide_banner', '-buildconf'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    if '--disable-neon' in result.stdout:
+        log.warning("ffmpeg was built with --disable-neon, scaling and encoding will be slow on this ARM machine. "
+                    "Use an ffmpeg build with NEON enabled.")
 
-        video_with_text = CompositeVideoClip([video_clip, txt_clip])
-        return video_with_text
-    except Exception as e:
-        log.error(f"Failed to create video file with burned in text: {str(e)}")
-        raise RuntimeError(f"Failed to create video file with burned in text.") from e
+def run_ffmpeg(cmd, description, progress_callback=None, stall_timeout=FFMPEG_STALL_TIMEOUT):
+    """
+    Runs ffmpeg and raises a RuntimeError when it fails or its output stalls for stall_timeout seconds.
+    Progress is read from stdout, every complete block of key=value pairs is passed to progress_callback.
+    Until the first output the timeout is FFMPEG_STARTUP_STALL_FACTOR times longer, encoders like libx264 write
+    nothing until their lookahead is filled, which takes minutes for slow presets on large frames.
+    """
+    cmd = [cmd[0], '-hide_banner', '-loglevel', 'error', '-nostats', '-progress', 'pipe:1', *cmd[1:]]
+    # Errors go to a file instead of a second pipe, ffmpeg can never block on it while progress is read
+    with tempfile.TemporaryFile(mode='w+') as stderr_file:
+        process = start_process(cmd, stdout=subprocess.PIPE, stderr=stderr_file, text=True)
+        finished = threading.Event()
+        stalled = threading.Event()
+        started = False
+        timeout = stall_timeout * FFMPEG_STARTUP_STALL_FACTOR
+        last_update = time.monotonic()
 
-def concatenate_clips(video_clips, first_clip, title):
-    log.debug("Merging video files")
+        def watchdog():
+            while not finished.wait(1):
+                if time.monotonic() - last_update > timeout:
+                    stalled.set()
+                    process.kill()
+                    return
+
+        watchdog_thread = threading.Thread(target=watchdog, daemon=True)
+        if stall_timeout:
+            watchdog_thread.start()
+        progress = {}
+        try:
+            for line in process.stdout:
+                key, _, value = line.strip().partition('=')
+                # Any movement of the output counts, the position alone can stand still while frames are written
+                if key in ('out_time_us', 'frame', 'total_size') and value != progress.get(key):
+                    if started or (key == 'out_time_us' and value.isdigit() and int(value) > 0):
+                        started = True
+                        timeout = stall_timeout
+                        last_update = time.monotonic()
+                progress[key] = value
+                # Every block ends with progress=continue or progress=end
+                if key == 'progress' and progress_callback:
+                    progress_callback(progress)
+            process.wait()
+        finally:
+            finished.set()
+            if stall_timeout:
+                watchdog_thread.join()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        stderr_file.seek(0)
+        errors = stderr_file.read()
+
+    if stalled.is_set():
+        log.error(errors[-4096:])
+        raise RuntimeError(f"Failed {description}, ffmpeg made no progress for {timeout} seconds.")
+    if process.returncode != 0:
+        log.error(errors[-4096:])
+        raise RuntimeError(f"Failed {description}.")
+    if errors:
+        log.debug(errors)
+
+def get_rotation(stream):
+    """Returns the clockwise rotation of a probed video stream in degrees, 0, 90, 180 or 270."""
+    for side_data in stream.get('side_data_list', []):
+        if 'rotation' in side_data:
+            # The display matrix turns counterclockwise, older ffmpeg versions report the rotate tag instead
+            return -round(float(side_data['rotation']) / 90) * 90 % 360
     try:
-        all_clips = [first_clip] + video_clips
-        final_clip = concatenate_videoclips(all_clips, method="compose")
-        return final_clip
-    except Exception as e:
-        log.error(f"Failed to create video clip from file {title}: {str(e)}")
-        raise RuntimeError(f"Failed to create video clip from file {title}.") from e
-
-def write_output_file(final_clip, output_file_path, output_fps, threads, title, filmed_date):
-    final_clip.write_videofile(
-        output_file_path, 
-        fps=output_fps, 
-        codec="libx264",
-        preset="fast",
-        threads=threads,
-        write_logfile=False,
-        ffmpeg_params=[
-            "-metadata", f"title={title}",
-            "-metadata", f"description={title}",
-            "-metadata", f"creation_time={filmed_date}T00:00:00"  # Setting time to midnight. Adjust if you have precise time.
-        ]
+        return round(float(stream.get('tags', {}).get('rotate', 0)) / 90) * 90 % 360
+    except ValueError:
+        return 0
+
+def probe_segment(file_path):
+    """
+    Probes a segment once and returns its stream signature together with its duration. The signature holds
+    the stream parameters that must match for clips to be joined with the concat demuxer:
+    (video codec, width, height, frame rate, pixel format, audio codec, sample rate, channels, rotation)
+    The frame rate is the average rate rounded like Clip.get_fps does, r_frame_rate is often the timebase of phone
+    clips, and the exact average of variable frame rate clips differs between clips from the same phone.
+    Width and height are the coded size, phone clips filmed upright are stored sideways with a rotation.
+    """
+    cmd = [
+        'ffprobe', '-v', 'error', '-show_entries',
+        'stream=codec_type,codec_name,width,height,avg_frame_rate,r_frame_rate,pix_fmt,sample_rate,channels'
+        ':stream_tags=rotate:stream_side_data=rotation:format=duration',
+        '-of', 'json', str(file_path)
+    ]
+    result = run_process(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        log.error(result.stderr.strip())
+        raise RuntimeError(f"Failed to probe streams of {file_path}.")
+    probe = json.loads(result.stdout)
+    streams = probe.get('streams', [])
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), {})
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), {})
+    frame_rate = video.get('avg_frame_rate', '0/0')
+    if frame_rate.startswith('0/') or frame_rate.endswith('/0'):
+        frame_rate = video.get('r_frame_rate', '0/0')
+    num, _, denom = frame_rate.partition('/')
+    fps = round(int(num) / int(denom)) if denom.isdigit() and int(denom) else None
+    signature = (
+        video.get('codec_name'), video.get('width'), video.get('height'), fps, video.get('pix_fmt'),
+        audio.get('codec_name'), audio.get('sample_rate'), audio.get('channels'), get_rotation(video)
     )
+    return signature, float(probe.get('format', {}).get('duration', 0))
+
+def can_stream_copy(signatures):
+    """
+    Clips can be joined without re-encoding when all share the same streams and fit the target resolution.
+    The video has to be H.264 as well since the title cards are encoded with an H.264 encoder.
+    Title cards are never rotated, movies with rotated clips are re-encoded and ffmpeg autorotates them while decoding.
+    """
+    codec, width, height, _, pix_fmt, *_, rotation = signatures[0]
+    fits = width is not None and width <= TARGET_RESOLUTION[0] and height <= TARGET_RESOLUTION[1]
+    return (codec == 'h264' and pix_fmt == 'yuv420p' and fits and not rotation and
+            all(signature == signatures[0] for signature in signatures))
+
+def get_output_resolution(signatures):
+    """
+    Returns the size of the largest clip, scaled down to fit TARGET_RESOLUTION.
+    Movies made of smaller clips keep their size instead of being upscaled.
+    """
+    # Each clip is fitted on its own, mixing portrait and landscape clips must not combine their widest and tallest sides
+    sizes = [fit_resolution(*get_display_size(signature)) for signature in signatures if signature[1] and signature[2]]
+    if not sizes:
+        return TARGET_RESOLUTION
+    return max(sizes, key=lambda size: size[0] * size[1])
+
+def fit_resolution(width, height):
+    """Returns the size scaled down to fit TARGET_RESOLUTION with its aspect ratio kept, never scaled up."""
+    scale = min(1, TARGET_RESOLUTION[0] / width, TARGET_RESOLUTION[1] / height)
+    # libx264 needs even dimensions
+    return int(width * scale) // 2 * 2, int(height * scale) // 2 * 2
+
+def get_metadata_args(title, filmed_date):
+    return [
+        '-metadata', f"title={title}",
+        '-metadata', f"description={title}",
+        '-metadata', f"creation_time={filmed_date}T00:00:00",  # Setting time to midnight. Adjust if you have precise time.
+    ]
+
+def concatenate_clips(clip_paths, output_file_path, title, filmed_date, stall_timeout=FFMPEG_STALL_TIMEOUT):
+    """Joins clips that share a stream signature with the ffmpeg concat demuxer, without re-encoding."""
+    log.debug("Merging video files")
+    concat_list_path = Path(output_file_path).with_suffix('.txt')
+    with open(concat_list_path, 'w') as concat_list:
+        for clip_path in clip_paths:
+            # Single quotes are escaped as '\'' inside the concat list
+            escaped_path = str(Path(clip_path).resolve()).replace("'", "'\\''")
+            concat_list.write(f"file '{escaped_path}'\n")
+
+    cmd = [
+        'ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', str(concat_list_path),
+        # Only the first video and audio stream, data and timecode tracks of phone recordings do not fit in mp4
+        '-map', '0:v:0', '-map', '0:a:0?', '-c', 'copy', '-movflags', '+faststart', '-write_tmcd', '0',
+        *get_metadata_args(title, filmed_date),
+        str(output_file_path)
+    ]
+    try:
+        run_ffmpeg(cmd, f"concatenating clips for {title}", stall_timeout=stall_timeout)
+    finally:
+        concat_list_path.unlink(missing_ok=True)
+
+def get_display_size(signature):
+    """Returns the size a clip is shown at, ffmpeg autorotates clips turned by 90 or 270 degrees when decoding."""
+    _, width, height, *_, rotation = signature
+    return (height, width) if rotation in (90, 270) else (width, height)
+
+def needs_padding(signature, width, height):
+    """Clips with the same aspect ratio as the output are scaled without padding."""
+    clip_width, clip_height = get_display_size(signature)
+    return not clip_width or clip_width * height != clip_height * width
+
+def get_clip_filters(index, signature, duration, width, height, fps, cuda=False):
+    """
+    Returns the filters normalizing input index to the output resolution and frame rate, with stereo 48 kHz audio,
+    as the [v<index>] and [a<index>] streams. With cuda the video is scaled in GPU memory, which has no padding.
+    """
+    if cuda:
+        video_filters = [f'scale_cuda={width}:{height}:format=yuv420p', 'setsar=1', f'fps={fps}']
+    else:
+        video_filters = []
+        # Clips already at the output size are not scaled, and clips of the same aspect ratio are not padded
+        if get_display_size(signature) != (width, height):
+            video_filters.append(f'scale={width}:{height}:force_original_aspect_ratio=decrease:flags=lanczos')
+            if needs_padding(signature, width, height):
+                video_filters.append(f'pad={width}:{height}:(ow-iw)/2:(oh-ih)/2')
+        video_filters += ['setsar=1', f'fps={fps}', 'format=yuv420p']
+    filters = [f'[{index}:v:0]{",".join(video_filters)}[v{index}]']
+    if signature[5]:
+        filters.append(f'[{index}:a:0]aresample=48000,aformat=channel_layouts=stereo[a{index}]')
+    else:
+        # Clips without audio get a silent track of the same length so concat stays in sync
+        filters.append(f'anullsrc=channel_layout=stereo:sample_rate=48000,atrim=duration={duration}[a{index}]')
+    return filters
+
+def get_filter_graph_args(filters, encoder, video_label, audio_label, hw_frames=False):
+    """Returns the -filter_complex and -map arguments, with any filter the encoder needs appended to the video."""
+    upload_filter = None if hw_frames else encoder.video_filter()
+    if upload_filter:
+        filters = filters + [f'{video_label}{upload_filter}[vout]']
+        video_label = '[vout]'
+    return ['-filter_complex', ';'.join(filters), '-map', video_label, '-map', audio_label]
+
+def run_encode(cmd, output_args, encoder, threads, description, hw_frames=False, stall_timeout=FFMPEG_STALL_TIMEOUT):
+    """Encodes the inputs and filter graph of cmd, in two passes when the encoder has a target bitrate."""
+    if encoder.bitrate:
+        # The first pass only gathers rate statistics for the second, its output is discarded
+        with tempfile.TemporaryDirectory() as stats_dir:
+            passlogfile = Path(stats_dir) / 'ffmpeg2pass'
+            run_ffmpeg(
+                cmd + encoder.two_pass_args(1, passlogfile) + ['-c:a', 'aac', '-threads', str(threads), '-f', 'null', '-'],
+                f"first pass {description}", stall_timeout=stall_timeout
+            )
+            run_ffmpeg(
+                cmd + encoder.two_pass_args(2, passlogfile) + output_args, f"second pass {description}",
+                stall_timeout=stall_timeout
+            )
+    else:
+        run_ffmpeg(cmd + encoder.codec_args(hw_frames) + output_args, description, stall_timeout=stall_timeout)
+
+def encode_clips(clip_paths, signatures, durations, output_file_path, fps, title, filmed_date, encoder, threads,
+                 stall_timeout=FFMPEG_STALL_TIMEOUT):
+    """
+    Joins clips with different formats in a single ffmpeg pass. Every input is scaled and padded to the
+    output resolution and frame rate inside one filter graph, and everything is concatenated and encoded once.
+    """
+    log.debug("Merging and encoding video files")
+    width, height = get_output_resolution(signatures)
+    cmd = ['ffmpeg', '-y']
+    for clip_path in clip_paths:
+        cmd += [*encoder.input_args(), '-i', str(clip_path)]
+
+    filters = []
+    concat_inputs = ''
+    for index, (signature, duration) in enumerate(zip(signatures, durations)):
+        filters += get_clip_filters(index, signature, duration, width, height, fps)
+        concat_inputs += f'[v{index}][a{index}]'
+    filters.append(f'{concat_inputs}concat=n={len(clip_paths)}:v=1:a=1[v][a]')
+
+    cmd += get_filter_graph_args(filters, encoder, '[v]', '[a]')
+    output_args = [
+        '-c:a', 'aac', '-b:a', '192k', '-movflags', '+faststart', '-write_tmcd', '0', *get_metadata_args(title, filmed_date),
+        '-threads', str(threads), str(output_file_path)
+    ]
+    run_encode(cmd, output_args, encoder, threads, f"encoding clips for {title}", stall_timeout=stall_timeout)
+
+def encode_clips_in_parallel(clip_paths, signatures, durations, output_file_path, fps, title, filmed_date, encoder, threads,
+                             work_dir, workers, stall_timeout=FFMPEG_STALL_TIMEOUT):
+    """
+    Normalizes every clip to the same format in its own ffmpeg process, several at once, and joins the results by
+    stream copy. One ffmpeg at a fast preset keeps only a few cores busy, this spreads long re-encodes over more.
+    """
+    log.debug(f"Encoding video files with {workers} parallel ffmpeg processes")
+    width, height = get_output_resolution(signatures)
+
+    def encode_segment(index):
+        segment_path = Path(work_dir) / f"segment_{index:04d}.mp4"
+        output_args = ['-c:a', 'aac', '-b:a', '192k', '-threads', str(threads), str(segment_path)]
+        description = f"encoding {clip_paths[index]} for {title}"
+
+        # Clips that need no padding are decoded, scaled and encoded in GPU memory with NVENC. Rotated clips cannot be
+        # autorotated in GPU memory, they always use the CPU filters below.
+        rotation = signatures[index][-1]
+        if encoder.cuda_pipeline and not rotation and not needs_padding(signatures[index], width, height):
+            cmd = ['ffmpeg', '-y', *encoder.input_args(hw_frames=True), '-i', str(clip_paths[index])]
+            filters = get_clip_filters(0, signatures[index], durations[index], width, height, fps, cuda=True)
+            cmd += get_filter_graph_args(filters, encoder, '[v0]', '[a0]', hw_frames=True)
+            try:
+                run_encode(
+                    cmd, output_args, encoder, threads, f"{description} on the GPU", hw_frames=True,
+                    stall_timeout=stall_timeout
+                )
+                return segment_path
+            except RuntimeError:
+                log.warning(f"Encoding {clip_paths[index]} on the GPU failed, retrying with CPU filters.")
+
+        cmd = ['ffmpeg', '-y', *encoder.input_args(), '-i', str(clip_paths[index])]
+        filters = get_clip_filters(0, signatures[index], durations[index], width, height, fps)
+        cmd += get_filter_graph_args(filters, encoder, '[v0]', '[a0]')
+        run_encode(cmd, output_args, encoder, threads, description, stall_timeout=stall_timeout)
+        return segment_path
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        segment_paths = list(executor.map(encode_segment, range(len(clip_paths))))
+    concatenate_clips(segment_paths, output_file_path, title, filmed_date, stall_timeout)
 
 def sort_clips_by_date(clips):
-    for clip in clips:
-        log.debug(f"Sorting clip: {clip.file_name}, creation_date: {clip.creation_date}, type: {type(clip.creation_date)}")
-    return sorted(clips, key=lambda clip: clip.creation_date)
+    # Skip formatting a line per clip unless it is logged
+    if log.isEnabledFor(DEBUG):
+        for clip in clips:
+            log.debug(f"Sorting clip: {clip.file_name}, creation_date: {clip.creation_date}, type: {type(clip.creation_date)}")
+    return sorted(clips, key=attrgetter('creation_date'))